@@ -1,7 +1,8 @@
+import io
 import os
-import json
+import orjson
 import re
-import base64
+import binascii
 import aiohttp # Async test. Need to install
 import asyncio
 
@@ -15,17 +16,111 @@ if API_KEY is None:
 MODEL_LANDSCAPE = "gemini-3.0-pro-image-landscape"
 MODEL_PORTRAIT = "gemini-3.0-pro-image-portrait"
 
-# 修改: 增加 model 参数，默认为 None
-async def request_backend_generation(
+# Markdown 图片链接: ![...](url)
+_IMG_MD_RE = re.compile(r'!\[.*?\]\((.*?)\)')
+_DATA_URI_PREFIX = "data:image/jpeg;base64,"
+
+# 设置 GEMINI_FLOW2API_DEBUG_STREAM=1 时输出思考过程 (缓冲后批量写出)
+_DEBUG_STREAM = os.getenv('GEMINI_FLOW2API_DEBUG_STREAM') == '1'
+_REASONING_FLUSH_SIZE = 4096
+
+# 复用的 HTTP 会话 (连接池 + keep-alive)，首次使用时创建
+_session: aiohttp.ClientSession | None = None
+_TIMEOUT = aiohttp.ClientTimeout(total=120, sock_read=60)
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """获取全局复用的 ClientSession，避免每次请求重新握手"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=32,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            ttl_dns_cache=300
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=_TIMEOUT)
+    return _session
+
+
+async def close_session():
+    """关闭全局 ClientSession (程序退出前调用)"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def warmup() -> None:
+    """预热连接池：提前对后端发起一次 HEAD 请求，完成 TCP/TLS 握手并保留 keep-alive 连接"""
+    try:
+        session = await get_session()
+        async with session.head(BASE_URL, timeout=aiohttp.ClientTimeout(total=5)):
+            pass
+    except Exception as e:
+        print(f"[Backend] 连接预热失败 (忽略): {e}")
+
+
+def _flush_reasoning(buf: io.StringIO) -> None:
+    """输出并清空思考过程缓冲区"""
+    text = buf.getvalue()
+    if text:
+        print(text, end="", flush=True)
+        buf.seek(0)
+        buf.truncate()
+
+
+def _handle_sse_line(line: bytes, reasoning_buf: io.StringIO | None) -> tuple[bool, str | None]:
+    """处理一行 SSE 数据，返回 (是否收到 [DONE], 本行捕获的图片链接)"""
+    # 直接在 bytes 上判断前缀，orjson 可直接解析 bytes，无需逐行 decode
+    if line.startswith(b'{"error'):
+        chunk = orjson.loads(line)
+        delta = chunk.get("choices", [{}])[0].get("delta", {})
+        msg = delta['reasoning_content']
+        if '401' in msg:
+            msg += '\nAccess Token 已失效，需重新配置。'
+        elif '400' in msg:
+            msg += '\n返回内容被拦截。'
+        raise Exception(msg)
+
+    if not line.startswith(b'data: '):
+        return False, None
+
+    data = line[6:]
+    if data == b'[DONE]':
+        return True, None
+
+    try:
+        chunk = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return False, None
+    delta = chunk.get("choices", [{}])[0].get("delta", {})
+
+    # 思考过程先写入缓冲区，攒够后一次性输出
+    if reasoning_buf is not None and "reasoning_content" in delta:
+        reasoning_buf.write(delta['reasoning_content'])
+        if reasoning_buf.tell() >= _REASONING_FLUSH_SIZE:
+            _flush_reasoning(reasoning_buf)
+
+    # 提取内容中的图片链接
+    if "content" in delta:
+        img_match = _IMG_MD_RE.search(delta["content"])
+        if img_match:
+            image_url = img_match.group(1)
+            if reasoning_buf is not None:
+                _flush_reasoning(reasoning_buf)
+            print(f"\n[Backend] 捕获图片链接: {image_url}")
+            return False, image_url
+    return False, None
+
+
+async def _request_image_url(
         prompt: str,
         images: list[bytes] = None,
-        model: str = None) -> bytes | None:
+        model: str = None) -> str | None:
     """
-    请求后端生成图片。
-    :param prompt: 提示词
-    :param images: 图片二进制列表
-    :param model: 指定模型名称 (可选)
-    :return: 成功返回图片bytes，失败返回None
+    发起生成请求并解析 SSE 流，返回生成图片的链接，未捕获到链接时返回None
     """
     # 更新token
     images = images or []
@@ -37,12 +132,13 @@ async def request_backend_generation(
     if images:
         content_payload = [{"type": "text", "text": prompt}]
         print(f"[Backend] 正在处理 {len(images)} 张图片输入...")
-        for img_bytes in images:
-            b64_str = base64.b64encode(img_bytes).decode('utf-8')
-            content_payload.append({
+        content_payload.extend(
+            {
                 "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{b64_str}"}
-            })
+                "image_url": {"url": _DATA_URI_PREFIX + binascii.b2a_base64(img_bytes, newline=False).decode('ascii')}
+            }
+            for img_bytes in images
+        )
     else:
         content_payload = prompt
 
@@ -57,72 +153,84 @@ async def request_backend_generation(
         "Content-Type": "application/json"
     }
 
+    body = orjson.dumps(payload)
+
     image_url = None
+    reasoning_buf = io.StringIO() if _DEBUG_STREAM else None
     print(f"[Backend] Model: {use_model} | 发起请求: {prompt[:20]}...") 
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(BACKEND_URL, json=payload, headers=headers, timeout=120) as response:
-                if response.status != 200:
-                    err_text = await response.text()
-                    content = response.content
-                    print(f"[Backend Error] Status {response.status}: {err_text} {content}")
-                    raise Exception(f"API Error: {response.status}: {err_text}")
-
-                async for line in response.content:
-                    line_str = line.decode('utf-8').strip()
-                    if line_str.startswith('{"error'):
-                        chunk = json.loads(data_str)
-                        delta = chunk.get("choices", [{}])[0].get("delta", {})
-                        msg = delta['reasoning_content']
-                        if '401' in msg:
-                            msg += '\nAccess Token 已失效，需重新配置。'
-                        elif '400' in msg:
-                            msg += '\n返回内容被拦截。'
-                        raise Exception(msg)
-
-                    if not line_str or not line_str.startswith('data: '):
-                        continue
-                    
-                    data_str = line_str[6:]
-                    if data_str == '[DONE]':
+        session = await get_session()
+        async with session.post(BACKEND_URL, data=body, headers=headers) as response:
+            if response.status != 200:
+                err_text = await response.text()
+                content = response.content
+                print(f"[Backend Error] Status {response.status}: {err_text} {content}")
+                raise Exception(f"API Error: {response.status}: {err_text}")
+
+            # 以 64 KiB 为单位读取，再按行切分 SSE 事件，减少每行一次的 await
+            buf = bytearray()
+            done = False
+            async for raw in response.content.iter_chunked(65536):
+                buf.extend(raw)
+                while (nl := buf.find(b'\n')) != -1:
+                    line = bytes(buf[:nl]).strip()
+                    del buf[:nl + 1]
+                    done, url = _handle_sse_line(line, reasoning_buf)
+                    if url:
+                        image_url = url
+                    if done:
                         break
-                    
-                    try:
-                        chunk = json.loads(data_str)
-                        delta = chunk.get("choices", [{}])[0].get("delta", {})
-                        
-                        # 打印思考过程
-                        if "reasoning_content" in delta:
-                            print(delta['reasoning_content'], end="", flush=True)
-
-                        # 提取内容中的图片链接
-                        if "content" in delta:
-                            content_text = delta["content"]
-                            img_match = re.search(r'!\[.*?\]\((.*?)\)', content_text)
-                            if img_match:
-                                image_url = img_match.group(1)
-                                print(f"\n[Backend] 捕获图片链接: {image_url}")
-                    except json.JSONDecodeError:
-                        continue
-            
-            # 3. 下载生成的图片
-            if image_url:
-                async with session.get(image_url) as img_resp:
-                    if img_resp.status == 200:
-                        image_bytes = await img_resp.read()
-                        return image_bytes
-                    else:
-                        print(f"[Backend Error] 图片下载失败: {img_resp.status}")
+                if done:
+                    break
+
+            # 流末尾可能残留一行没有换行符的数据，同样需要处理
+            if not done and (line := bytes(buf).strip()):
+                _, url = _handle_sse_line(line, reasoning_buf)
+                if url:
+                    image_url = url
     except Exception as e:
         print(f"[Backend Exception] {e}")
         raise e 
+    finally:
+        if reasoning_buf is not None:
+            _flush_reasoning(reasoning_buf)
         
-    return None
+    return image_url
+
+
+# 修改: 增加 model 参数，默认为 None
+async def request_backend_generation(
+        prompt: str,
+        images: list[bytes] = None,
+        model: str = None) -> bytes | None:
+    """
+    请求后端生成图片。
+    :param prompt: 提示词
+    :param images: 图片二进制列表
+    :param model: 指定模型名称 (可选)
+    :return: 成功返回图片bytes，失败返回None
+    """
+    image_url = await _request_image_url(prompt, images, model)
+    if not image_url:
+        return None
+
+    # 3. 下载生成的图片，按 64 KiB 分块读取
+    session = await get_session()
+    async with session.get(image_url) as img_resp:
+        if img_resp.status != 200:
+            print(f"[Backend Error] 图片下载失败: {img_resp.status}")
+            return None
+        buf = bytearray()
+        async for chunk in img_resp.content.iter_chunked(65536):
+            buf.extend(chunk)
+        return bytes(buf)
+
 
 if __name__ == '__main__':
     async def main():
         print("=== AI 绘图接口测试 ===")
+        await warmup()
         user_prompt = input("请输入提示词 (例如 '一只猫'): ").strip()
         if not user_prompt:
             user_prompt = "A cute cat in the garden"
@@ -134,7 +242,10 @@ if __name__ == '__main__':
         # with open("output_test.jpg", "rb") as f: img_data = f.read()
         # result = await request_backend_generation(user_prompt, [img_data])
         
-        result = await request_backend_generation(user_prompt)
+        try:
+            result = await request_backend_generation(user_prompt)
+        finally:
+            await close_session()
         
         if result:
             filename = "output_test.jpg"
@@ -3,11 +3,12 @@ from fastapi import APIRouter, Depends, HTTPException, Header, Request
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import Optional, List
+from datetime import datetime, timezone
 import secrets
 from ..core.auth import AuthManager
 from ..core.database import Database
 from ..core.config import config
-from ..services.token_manager import TokenManager
+from ..services.token_manager import TokenManager, parse_expires
 from ..services.proxy_manager import ProxyManager
 
 router = APIRouter()
@@ -170,6 +171,7 @@ async def change_password(
         update_params["username"] = request.username
 
     await db.update_admin_config(**update_params)
+    token_manager.invalidate_admin_config_cache()
 
     # 🔥 Hot reload: sync database config to memory
     await db.reload_config_to_memory()
@@ -268,13 +270,7 @@ async def update_token(
         expires = result.get("expires")
 
         # 解析过期时间
-        from datetime import datetime
-        at_expires = None
-        if expires:
-            try:
-                at_expires = datetime.fromisoformat(expires.replace('Z', '+00:00'))
-            except:
-                pass
+        at_expires = parse_expires(expires)
 
         # 更新token (包含AT、ST、AT过期时间、project_id和project_name)
         await token_manager.update_token(
@@ -399,7 +395,6 @@ async def import_tokens(
     token: str = Depends(verify_admin_token)
 ):
     """批量导入Token"""
-    from datetime import datetime, timezone
 
     added = 0
     updated = 0
@@ -425,20 +420,12 @@ async def import_tokens(
                     continue
 
                 # 解析过期时间
-                at_expires = None
-                is_expired = False
-                if expires:
-                    try:
-                        at_expires = datetime.fromisoformat(expires.replace('Z', '+00:00'))
-                        # 判断是否过期
-                        now = datetime.now(timezone.utc)
-                        is_expired = at_expires <= now
-                    except:
-                        pass
-
-                # 使用邮箱检查是否已存在
-                existing_tokens = await token_manager.get_all_tokens()
-                existing = next((t for t in existing_tokens if t.email == email), None)
+                at_expires = parse_expires(expires)
+                # 判断是否过期
+                is_expired = at_expires is not None and at_expires <= datetime.now(timezone.utc)
+
+                # 使用邮箱检查是否已存在 (走 idx_tokens_email 索引)
+                existing = await db.get_token_by_email(email)
 
                 if existing:
                     # 更新现有Token
@@ -681,6 +668,7 @@ async def update_admin_config(
     """Update admin configuration (error_ban_threshold)"""
     # Update error_ban_threshold in database
     await db.update_admin_config(error_ban_threshold=request.error_ban_threshold)
+    token_manager.invalidate_admin_config_cache()
 
     return {"success": True, "message": "配置更新成功"}
 
@@ -702,6 +690,7 @@ async def update_api_key(
     """Update API key (for external API calls, NOT for admin login)"""
     # Update API key in database
     await db.update_admin_config(api_key=request.new_api_key)
+    token_manager.invalidate_admin_config_cache()
 
     # 🔥 Hot reload: sync database config to memory
     await db.reload_config_to_memory()
@@ -976,13 +965,7 @@ async def plugin_update_token(request: dict, authorization: Optional[str] = Head
             raise HTTPException(status_code=400, detail="Failed to get email from session token")
 
         # Parse expiration time
-        from datetime import datetime
-        at_expires = None
-        if expires:
-            try:
-                at_expires = datetime.fromisoformat(expires.replace('Z', '+00:00'))
-            except:
-                pass
+        at_expires = parse_expires(expires)
 
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid session token: {str(e)}")
@@ -1,11 +1,11 @@
 """API routes - OpenAI compatible endpoints"""
 from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
-from typing import List, Optional
-import base64
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from typing import List, Optional, Union
+import binascii
+import mmap
 import re
-import json
-from curl_cffi.requests import AsyncSession
+import orjson
 import time
 from urllib.parse import urlparse
 from ..core.auth import verify_api_key_header
@@ -15,6 +15,9 @@ from ..core.logger import debug_logger
 
 router = APIRouter()
 
+# 预编译正则
+_MD_IMG_RE = re.compile(r"!\[.*?\]\((.*?)\)")
+
 # Dependency injection will be set up in main.py
 generation_handler: GenerationHandler = None
 
@@ -25,34 +28,40 @@ def set_generation_handler(handler: GenerationHandler):
     generation_handler = handler
 
 
-async def retrieve_image_data(url: str) -> Optional[bytes]:
+async def retrieve_image_data(url: str) -> Optional[Union[bytes, mmap.mmap]]:
     """
     智能获取图片数据：
-    1. 优先检查是否为本地 /tmp/ 缓存文件，如果是则直接读取磁盘
+    1. 优先检查是否为本地 /tmp/ 缓存文件，如果是则立即 mmap 映射 (不整体读入内存)，
+       映射在缓存清理删除文件后依然有效
     2. 如果本地不存在或是外部链接，则进行网络下载
     """
     # 优先尝试本地读取
     try:
         if "/tmp/" in url and generation_handler and generation_handler.file_cache:
-            path = urlparse(url).path
-            filename = path.split("/tmp/")[-1]
+            filename = urlparse(url).path.rpartition("/tmp/")[2]
             local_file_path = generation_handler.file_cache.cache_dir / filename
 
-            if local_file_path.exists() and local_file_path.is_file():
-                data = local_file_path.read_bytes()
-                if data:
-                    return data
+            if local_file_path.is_file() and local_file_path.stat().st_size > 0:
+                with open(local_file_path, "rb") as f:
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
     except Exception as e:
         debug_logger.log_warning(f"[CONTEXT] 本地缓存读取失败: {str(e)}")
 
     # 回退逻辑：网络下载
     try:
-        async with AsyncSession() as session:
-            response = await session.get(url, timeout=30, impersonate="chrome110", verify=False)
+        session = generation_handler.get_image_session()
+        response = await session.get(url, stream=True)
+        try:
             if response.status_code == 200:
-                return response.content
+                buf = bytearray()
+                async for chunk in response.aiter_content():
+                    buf.extend(chunk)
+                return bytes(buf)
             else:
+                # 非200直接放弃，不读取响应体
                 debug_logger.log_warning(f"[CONTEXT] 图片下载失败，状态码: {response.status_code}")
+        finally:
+            await response.aclose()
     except Exception as e:
         debug_logger.log_error(f"[CONTEXT] 图片下载异常: {str(e)}")
 
@@ -100,7 +109,7 @@ async def create_chat_completion(
 
         # Handle both string and array format (OpenAI multimodal)
         prompt = ""
-        images: List[bytes] = []
+        images: List[Union[bytes, mmap.mmap]] = []
 
         if isinstance(content, str):
             # Simple text format
@@ -115,10 +124,10 @@ async def create_chat_completion(
                     image_url = item.get("image_url", {}).get("url", "")
                     if image_url.startswith("data:image"):
                         # Parse base64
-                        match = re.search(r"base64,(.+)", image_url)
-                        if match:
-                            image_base64 = match.group(1)
-                            image_bytes = base64.b64decode(image_base64)
+                        idx = image_url.find("base64,")
+                        if idx != -1:
+                            image_base64 = image_url[idx + 7:]
+                            image_bytes = binascii.a2b_base64(image_base64)
                             images.append(image_bytes)
                     elif image_url:
                         # 尝试下载或读取本地缓存
@@ -132,10 +141,10 @@ async def create_chat_completion(
         # Fallback to deprecated image parameter
         if request.image and not images:
             if request.image.startswith("data:image"):
-                match = re.search(r"base64,(.+)", request.image)
-                if match:
-                    image_base64 = match.group(1)
-                    image_bytes = base64.b64decode(image_base64)
+                idx = request.image.find("base64,")
+                if idx != -1:
+                    image_base64 = request.image[idx + 7:]
+                    image_bytes = binascii.a2b_base64(image_base64)
                     images.append(image_bytes)
 
         # 自动参考图：仅对图片模型生效
@@ -145,17 +154,21 @@ async def create_chat_completion(
             debug_logger.log_info(f"[CONTEXT] 开始查找历史参考图，消息数量: {len(request.messages)}")
 
             # 查找上一次 assistant 回复的图片
-            for msg in reversed(request.messages[:-1]):
+            for i in range(len(request.messages) - 2, -1, -1):
+                msg = request.messages[i]
                 if msg.role == "assistant" and isinstance(msg.content, str):
                     # 匹配 Markdown 图片格式: ![...](http...)
-                    matches = re.findall(r"!\[.*?\]\((.*?)\)", msg.content)
-                    if matches:
-                        last_image_url = matches[-1]
+                    # 只保留最后一个匹配，不构建完整列表
+                    last = None
+                    for last in _MD_IMG_RE.finditer(msg.content):
+                        pass
+                    if last is not None:
+                        last_image_url = last.group(1)
 
                         if last_image_url.startswith("http"):
                             try:
                                 downloaded_bytes = await retrieve_image_data(last_image_url)
-                                if downloaded_bytes and len(downloaded_bytes) > 0:
+                                if downloaded_bytes:
                                     # 将历史图片插入到最前面
                                     images.insert(0, downloaded_bytes)
                                     debug_logger.log_info(f"[CONTEXT] ✅ 添加历史参考图: {last_image_url}")
@@ -211,11 +224,11 @@ async def create_chat_completion(
             if result:
                 # Parse the result JSON string
                 try:
-                    result_json = json.loads(result)
-                    return JSONResponse(content=result_json)
-                except json.JSONDecodeError:
+                    result_json = orjson.loads(result)
+                    return ORJSONResponse(content=result_json)
+                except orjson.JSONDecodeError:
                     # If not JSON, return as-is
-                    return JSONResponse(content={"result": result})
+                    return ORJSONResponse(content={"result": result})
             else:
                 raise HTTPException(status_code=500, detail="Generation failed: No response from handler")
 
@@ -56,6 +56,16 @@ class Config:
     def flow_timeout(self) -> int:
         return self._config["flow"]["timeout"]
 
+    @property
+    def flow_http2(self) -> bool:
+        """Use HTTP/2 for Flow API requests (disable to fall back to HTTP/1.1)"""
+        return self._config["flow"].get("http2", True)
+
+    @property
+    def flow_max_clients(self) -> int:
+        """Max concurrent requests per shared curl_cffi session (curl_cffi defaults to 10)"""
+        return self._config["flow"].get("max_clients", 256)
+
     @property
     def flow_max_retries(self) -> int:
         return self._config["flow"]["max_retries"]
@@ -235,5 +245,10 @@ class Config:
             self._config["captcha"] = {}
         self._config["captcha"]["capsolver_base_url"] = base_url
 
+    @property
+    def captcha_prefetch(self) -> bool:
+        """Get whether to prefetch the next reCAPTCHA token per project"""
+        return self._config.get("captcha", {}).get("prefetch", False)
+
 # Global config instance
 config = Config()
@@ -1,8 +1,10 @@
 """Database storage layer for Flow2API"""
+import asyncio
 import aiosqlite
 import json
-from datetime import datetime
-from typing import Optional, List
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from typing import AsyncIterator, Optional, List, Tuple
 from pathlib import Path
 from .models import Token, TokenStats, Task, RequestLog, AdminConfig, ProxyConfig, GenerationConfig, CacheConfig, Project, CaptchaConfig, PluginConfig
 
@@ -17,6 +19,39 @@ class Database:
             data_dir.mkdir(exist_ok=True)
             db_path = str(data_dir / "flow.db")
         self.db_path = db_path
+        # 进程内复用的单个连接；每次使用时加锁，保证一个方法内的语句和 commit 不与其他协程交错
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._conn_lock = asyncio.Lock()
+        # tokens 表修订号: 影响 token 选择的写入 (增删、启用/禁用、AT 等字段更新) 后递增，供上层缓存判断是否失效
+        self.tokens_revision = 0
+
+    @asynccontextmanager
+    async def _connect(self) -> AsyncIterator[aiosqlite.Connection]:
+        """获取共享连接 (首次使用时打开并启用 WAL)"""
+        async with self._conn_lock:
+            if self._conn is None:
+                conn = aiosqlite.connect(self.db_path)
+                # 未调用 close() 时也不阻塞进程退出
+                conn.daemon = True
+                await conn
+                await conn.execute("PRAGMA journal_mode=WAL")
+                self._conn = conn
+            conn = self._conn
+            # 与原先每次新建连接的行为保持一致: 默认返回 tuple
+            conn.row_factory = None
+            try:
+                yield conn
+            finally:
+                # 未提交的写入 (包括异常中断) 回滚，等同于原先关闭连接时丢弃
+                if conn.in_transaction:
+                    await conn.rollback()
+
+    async def close(self):
+        """Close the shared connection"""
+        async with self._conn_lock:
+            if self._conn is not None:
+                await self._conn.close()
+                self._conn = None
 
     def db_exists(self) -> bool:
         """Check if database file exists"""
@@ -193,7 +228,7 @@ class Database:
                         Used only to initialize missing config rows with default values.
                         Existing config rows will NOT be overwritten.
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             print("Checking database integrity and performing migrations...")
 
             # ========== Step 1: Create missing tables ==========
@@ -331,7 +366,7 @@ class Database:
 
     async def init_db(self):
         """Initialize database tables"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             # Tokens table (Flow2API版本)
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS tokens (
@@ -513,6 +548,7 @@ class Database:
             # Create indexes
             await db.execute("CREATE INDEX IF NOT EXISTS idx_task_id ON tasks(task_id)")
             await db.execute("CREATE INDEX IF NOT EXISTS idx_token_st ON tokens(st)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_tokens_email ON tokens(email)")
             await db.execute("CREATE INDEX IF NOT EXISTS idx_project_id ON projects(project_id)")
 
             # Migrate request_logs table if needed
@@ -577,7 +613,7 @@ class Database:
     # Token operations
     async def add_token(self, token: Token) -> int:
         """Add a new token"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             cursor = await db.execute("""
                 INSERT INTO tokens (st, at, at_expires, email, name, remark, is_active,
                                    credits, user_paygate_tier, current_project_id, current_project_name,
@@ -596,12 +632,13 @@ class Database:
                 INSERT INTO token_stats (token_id) VALUES (?)
             """, (token_id,))
             await db.commit()
+            self.tokens_revision += 1
 
             return token_id
 
     async def get_token(self, token_id: int) -> Optional[Token]:
         """Get token by ID"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM tokens WHERE id = ?", (token_id,))
             row = await cursor.fetchone()
@@ -611,7 +648,7 @@ class Database:
 
     async def get_token_by_st(self, st: str) -> Optional[Token]:
         """Get token by ST"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM tokens WHERE st = ?", (st,))
             row = await cursor.fetchone()
@@ -621,9 +658,9 @@ class Database:
 
     async def get_token_by_email(self, email: str) -> Optional[Token]:
         """Get token by email"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT * FROM tokens WHERE email = ?", (email,))
+            cursor = await db.execute("SELECT * FROM tokens WHERE email = ? LIMIT 1", (email,))
             row = await cursor.fetchone()
             if row:
                 return Token(**dict(row))
@@ -631,7 +668,7 @@ class Database:
 
     async def get_all_tokens(self) -> List[Token]:
         """Get all tokens"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM tokens ORDER BY created_at DESC")
             rows = await cursor.fetchall()
@@ -639,7 +676,7 @@ class Database:
 
     async def get_active_tokens(self) -> List[Token]:
         """Get all active tokens"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM tokens WHERE is_active = 1 ORDER BY last_used_at ASC")
             rows = await cursor.fetchall()
@@ -647,7 +684,7 @@ class Database:
 
     async def update_token(self, token_id: int, **kwargs):
         """Update token fields"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             updates = []
             params = []
 
@@ -661,19 +698,62 @@ class Database:
                 query = f"UPDATE tokens SET {', '.join(updates)} WHERE id = ?"
                 await db.execute(query, params)
                 await db.commit()
+                self.tokens_revision += 1
+
+    async def enable_token(self, token_id: int):
+        """Enable token and reset its consecutive error count in one transaction"""
+        async with self._connect() as db:
+            await db.execute("UPDATE tokens SET is_active = 1 WHERE id = ?", (token_id,))
+            await db.execute("""
+                UPDATE token_stats SET consecutive_error_count = 0 WHERE token_id = ?
+            """, (token_id,))
+            await db.commit()
+            self.tokens_revision += 1
+
+    async def auto_unban_429_tokens(self, now: datetime, cutoff: datetime) -> List[int]:
+        """Unban 429-banned tokens banned before cutoff whose AT is still valid, return their IDs
+
+        Timestamps go through SQLite datetime() so offset-aware and naive (UTC) values compare correctly.
+        """
+        async with self._connect() as db:
+            cursor = await db.execute("""
+                SELECT id FROM tokens
+                WHERE ban_reason = '429_rate_limit'
+                  AND is_active = 0
+                  AND banned_at IS NOT NULL
+                  AND datetime(banned_at) <= datetime(?)
+                  AND (at_expires IS NULL OR datetime(at_expires) > datetime(?))
+            """, (cutoff.isoformat(), now.isoformat()))
+            token_ids = [row[0] for row in await cursor.fetchall()]
+            if not token_ids:
+                return []
+
+            placeholders = ",".join("?" * len(token_ids))
+            await db.execute(
+                f"UPDATE tokens SET is_active = 1, ban_reason = NULL, banned_at = NULL WHERE id IN ({placeholders})",
+                token_ids
+            )
+            await db.execute(
+                f"UPDATE token_stats SET consecutive_error_count = 0 WHERE token_id IN ({placeholders})",
+                token_ids
+            )
+            await db.commit()
+            self.tokens_revision += 1
+            return token_ids
 
     async def delete_token(self, token_id: int):
         """Delete token and related data"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute("DELETE FROM token_stats WHERE token_id = ?", (token_id,))
             await db.execute("DELETE FROM projects WHERE token_id = ?", (token_id,))
             await db.execute("DELETE FROM tokens WHERE id = ?", (token_id,))
             await db.commit()
+            self.tokens_revision += 1
 
     # Project operations
     async def add_project(self, project: Project) -> int:
         """Add a new project"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             cursor = await db.execute("""
                 INSERT INTO projects (project_id, token_id, project_name, tool_name, is_active)
                 VALUES (?, ?, ?, ?, ?)
@@ -684,7 +764,7 @@ class Database:
 
     async def get_project_by_id(self, project_id: str) -> Optional[Project]:
         """Get project by UUID"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM projects WHERE project_id = ?", (project_id,))
             row = await cursor.fetchone()
@@ -694,7 +774,7 @@ class Database:
 
     async def get_projects_by_token(self, token_id: int) -> List[Project]:
         """Get all projects for a token"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute(
                 "SELECT * FROM projects WHERE token_id = ? ORDER BY created_at DESC",
@@ -705,14 +785,14 @@ class Database:
 
     async def delete_project(self, project_id: str):
         """Delete project"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute("DELETE FROM projects WHERE project_id = ?", (project_id,))
             await db.commit()
 
     # Task operations
     async def create_task(self, task: Task) -> int:
         """Create a new task"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             cursor = await db.execute("""
                 INSERT INTO tasks (task_id, token_id, model, prompt, status, progress, scene_id)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
@@ -723,7 +803,7 @@ class Database:
 
     async def get_task(self, task_id: str) -> Optional[Task]:
         """Get task by ID"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,))
             row = await cursor.fetchone()
@@ -737,7 +817,7 @@ class Database:
 
     async def update_task(self, task_id: str, **kwargs):
         """Update task"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             updates = []
             params = []
 
@@ -765,9 +845,37 @@ class Database:
         elif stat_type == "error":
             await self.increment_error_count(token_id)
 
+    async def record_usage_batch(self, usages: List[Tuple[int, int, int, datetime]]):
+        """Apply aggregated usage (token_id, image_n, video_n, last_used_at) in one transaction
+
+        Increments use_count/last_used_at on tokens and the image/video counters on token_stats;
+        today's counters restart when today_date changes.
+        """
+        if not usages:
+            return
+        today = str(date.today())
+        async with self._connect() as db:
+            await db.executemany(
+                "UPDATE tokens SET use_count = use_count + ?, last_used_at = ? WHERE id = ?",
+                [(image_n + video_n, used_at, token_id) for token_id, image_n, video_n, used_at in usages]
+            )
+            await db.executemany("""
+                UPDATE token_stats
+                SET image_count = image_count + ?,
+                    video_count = video_count + ?,
+                    today_image_count = CASE WHEN today_date = ? THEN today_image_count + ? ELSE ? END,
+                    today_video_count = CASE WHEN today_date = ? THEN today_video_count + ? ELSE ? END,
+                    today_date = ?
+                WHERE token_id = ?
+            """, [
+                (image_n, video_n, today, image_n, image_n, today, video_n, video_n, today, token_id)
+                for token_id, image_n, video_n, _ in usages
+            ])
+            await db.commit()
+
     async def get_token_stats(self, token_id: int) -> Optional[TokenStats]:
         """Get token statistics"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM token_stats WHERE token_id = ?", (token_id,))
             row = await cursor.fetchone()
@@ -777,8 +885,7 @@ class Database:
 
     async def increment_image_count(self, token_id: int):
         """Increment image generation count with daily reset"""
-        from datetime import date
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             today = str(date.today())
             # Get current stats
             cursor = await db.execute("SELECT today_date FROM token_stats WHERE token_id = ?", (token_id,))
@@ -806,8 +913,7 @@ class Database:
 
     async def increment_video_count(self, token_id: int):
         """Increment video generation count with daily reset"""
-        from datetime import date
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             today = str(date.today())
             # Get current stats
             cursor = await db.execute("SELECT today_date FROM token_stats WHERE token_id = ?", (token_id,))
@@ -841,8 +947,7 @@ class Database:
         - consecutive_error_count: Consecutive errors (reset on success/enable)
         - today_error_count: Today's errors (reset on date change)
         """
-        from datetime import date
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             today = str(date.today())
             # Get current stats
             cursor = await db.execute("SELECT today_date FROM token_stats WHERE token_id = ?", (token_id,))
@@ -881,7 +986,7 @@ class Database:
 
         Note: error_count (total historical errors) is NEVER reset
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute("""
                 UPDATE token_stats SET consecutive_error_count = 0 WHERE token_id = ?
             """, (token_id,))
@@ -890,7 +995,7 @@ class Database:
     # Config operations
     async def get_admin_config(self) -> Optional[AdminConfig]:
         """Get admin configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM admin_config WHERE id = 1")
             row = await cursor.fetchone()
@@ -900,7 +1005,7 @@ class Database:
 
     async def update_admin_config(self, **kwargs):
         """Update admin configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             updates = []
             params = []
 
@@ -917,7 +1022,7 @@ class Database:
 
     async def get_proxy_config(self) -> Optional[ProxyConfig]:
         """Get proxy configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM proxy_config WHERE id = 1")
             row = await cursor.fetchone()
@@ -927,7 +1032,7 @@ class Database:
 
     async def update_proxy_config(self, enabled: bool, proxy_url: Optional[str] = None):
         """Update proxy configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute("""
                 UPDATE proxy_config
                 SET enabled = ?, proxy_url = ?, updated_at = CURRENT_TIMESTAMP
@@ -937,7 +1042,7 @@ class Database:
 
     async def get_generation_config(self) -> Optional[GenerationConfig]:
         """Get generation configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM generation_config WHERE id = 1")
             row = await cursor.fetchone()
@@ -947,7 +1052,7 @@ class Database:
 
     async def update_generation_config(self, image_timeout: int, video_timeout: int):
         """Update generation configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute("""
                 UPDATE generation_config
                 SET image_timeout = ?, video_timeout = ?, updated_at = CURRENT_TIMESTAMP
@@ -958,7 +1063,7 @@ class Database:
     # Request log operations
     async def add_request_log(self, log: RequestLog):
         """Add request log"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute("""
                 INSERT INTO request_logs (token_id, operation, request_body, response_body, status_code, duration)
                 VALUES (?, ?, ?, ?, ?, ?)
@@ -968,7 +1073,7 @@ class Database:
 
     async def get_logs(self, limit: int = 100, token_id: Optional[int] = None):
         """Get request logs with token email"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
 
             if token_id:
@@ -1014,7 +1119,7 @@ class Database:
 
     async def clear_all_logs(self):
         """Clear all request logs"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute("DELETE FROM request_logs")
             await db.commit()
 
@@ -1027,7 +1132,7 @@ class Database:
             is_first_startup: If True, initialize all config rows from setting.toml.
                             If False (upgrade mode), only ensure missing config rows exist with default values.
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             if is_first_startup:
                 # First startup: Initialize all config tables with values from setting.toml
                 await self._ensure_config_rows(db, config_dict)
@@ -1085,7 +1190,7 @@ class Database:
     # Cache config operations
     async def get_cache_config(self) -> CacheConfig:
         """Get cache configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM cache_config WHERE id = 1")
             row = await cursor.fetchone()
@@ -1096,7 +1201,7 @@ class Database:
 
     async def update_cache_config(self, enabled: bool = None, timeout: int = None, base_url: Optional[str] = None):
         """Update cache configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             # Get current values
             cursor = await db.execute("SELECT * FROM cache_config WHERE id = 1")
@@ -1135,7 +1240,7 @@ class Database:
     async def get_debug_config(self) -> 'DebugConfig':
         """Get debug configuration"""
         from .models import DebugConfig
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM debug_config WHERE id = 1")
             row = await cursor.fetchone()
@@ -1152,7 +1257,7 @@ class Database:
         mask_token: bool = None
     ):
         """Update debug configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             # Get current values
             cursor = await db.execute("SELECT * FROM debug_config WHERE id = 1")
@@ -1188,7 +1293,7 @@ class Database:
     # Captcha config operations
     async def get_captcha_config(self) -> CaptchaConfig:
         """Get captcha configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM captcha_config WHERE id = 1")
             row = await cursor.fetchone()
@@ -1205,7 +1310,7 @@ class Database:
         capsolver_base_url: str = None
     ):
         """Update captcha configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM captcha_config WHERE id = 1")
             row = await cursor.fetchone()
@@ -1240,7 +1345,7 @@ class Database:
     # Plugin config operations
     async def get_plugin_config(self) -> PluginConfig:
         """Get plugin configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM plugin_config WHERE id = 1")
             row = await cursor.fetchone()
@@ -1250,7 +1355,7 @@ class Database:
 
     async def update_plugin_config(self, connection_token: str, auto_enable_on_update: bool = True):
         """Update plugin configuration"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM plugin_config WHERE id = 1")
             row = await cursor.fetchone()
@@ -1,7 +1,7 @@
 """Data models for Flow2API"""
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from typing import Optional, List, Union, Any
-from datetime import datetime
+from datetime import datetime, timezone
 
 
 class Token(BaseModel):
@@ -42,6 +42,14 @@ class Token(BaseModel):
     ban_reason: Optional[str] = None  # 禁用原因: "429_rate_limit" 或 None
     banned_at: Optional[datetime] = None  # 禁用时间
 
+    @field_validator("at_expires", "banned_at")
+    @classmethod
+    def _ensure_utc(cls, v: Optional[datetime]) -> Optional[datetime]:
+        """库中存储的无时区时间按 UTC 处理，读取时统一转为 aware datetime"""
+        if v is not None and v.tzinfo is None:
+            return v.replace(tzinfo=timezone.utc)
+        return v
+
 
 class Project(BaseModel):
     """Project model for VideoFX"""
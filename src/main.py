@@ -108,12 +108,18 @@ async def lifespan(app: FastAPI):
     print("Flow2API Shutting down...")
     # Stop file cache cleanup task
     await generation_handler.file_cache.stop_cleanup_task()
+    # Close shared HTTP sessions
+    await generation_handler.close()
+    await flow_client.aclose()
     # Stop auto-unban task
     auto_unban_task_handle.cancel()
     try:
         await auto_unban_task_handle
     except asyncio.CancelledError:
         pass
+    # Flush pending usage stats, then close shared database connection
+    await token_manager.close()
+    await db.close()
     # Close browser if initialized
     if browser_service:
         await browser_service.close()
@@ -1,9 +1,13 @@
 """Flow API Client for VideoFX (Veo)"""
+import asyncio
 import time
 import uuid
 import random
-import base64
-from typing import Dict, Any, Optional, List
+import binascii
+import mmap
+import orjson
+from typing import Dict, Any, Optional, List, Union
+from curl_cffi import CurlHttpVersion
 from curl_cffi.requests import AsyncSession
 from ..core.logger import debug_logger
 from ..core.config import config
@@ -19,14 +23,153 @@ class FlowAPIException(Exception):
         super().__init__(f"HTTP {status_code}: {self.status_text} - {self.error_message}")
 
 
+class FlowTransportError(Exception):
+    """请求未拿到API响应 (连接失败、超时、响应无法解析等)，cause 为原始异常"""
+    def __init__(self, message: str, cause: Exception):
+        self.cause = cause
+        super().__init__(message)
+
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# 生成请求的 seed 取值范围 (1-99999)
+_SEED_RANGE = range(1, 100000)
+
+# 视频生成接口
+_VIDEO_ENDPOINTS = {
+    "text": "/video:batchAsyncGenerateVideoText",
+    "reference": "/video:batchAsyncGenerateVideoReferenceImages",
+    "start_end": "/video:batchAsyncGenerateVideoStartAndEndImage",
+}
+
+# 非JSON错误响应保留的最大字节数
+_ERROR_TEXT_LIMIT = 4096
+
+# 区分"未传入"与显式传入 None
+_UNSET = object()
+
+# reCAPTCHA v3 token 有效期约2分钟，预取的token留出余量
+_RECAPTCHA_TTL = 110
+
+
+def _sniff_image_mime(head: bytes) -> str:
+    """根据文件头判断图片类型，无法识别时按jpeg处理"""
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    return "image/jpeg"
+
+
+def _encode_image(image: Union[bytes, mmap.mmap]) -> tuple:
+    """图片转base64，返回 (base64字符串, mimeType)；mmap 直接按缓冲区编码，不整体读入内存"""
+    return binascii.b2a_base64(image, newline=False).decode('ascii'), _sniff_image_mime(image[:12])
+
+
+class _StatusBatcher:
+    """合并同一AT下并发的视频状态查询，窗口期内的operation一次请求查完再按名称分发"""
+
+    def __init__(self, client: "FlowClient", window: float = 0.05):
+        self._client = client
+        self._window = window
+        self._pending: Dict[str, List[tuple]] = {}  # at -> [(operation, future)]
+        self._tasks: set = set()
+
+    async def poll_one(self, at: str, operation: Dict) -> dict:
+        """查询单个operation状态，返回结构与 check_video_status 相同"""
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.get(at)
+        if batch is None:
+            batch = self._pending[at] = []
+            task = asyncio.create_task(self._flush(at))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        batch.append((operation, future))
+        return await future
+
+    async def _flush(self, at: str):
+        await asyncio.sleep(self._window)
+        batch = self._pending.pop(at, [])
+        if not batch:
+            return
+
+        try:
+            result = await self._client.check_video_status(at, [op for op, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        by_name = {}
+        for item in result.get("operations", []):
+            name = item.get("operation", {}).get("name")
+            if name:
+                by_name[name] = item
+
+        for op, future in batch:
+            if future.done():
+                continue
+            item = by_name.get(op.get("operation", {}).get("name"))
+            future.set_result({"operations": [item] if item else []})
+
+
 class FlowClient:
     """VideoFX API客户端"""
 
+    _BASE_HEADERS = {
+        "Content-Type": "application/json",
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+    }
+    _ST_COOKIE_PREFIX = "__Secure-next-auth.session-token="
+    _BEARER_PREFIX = "Bearer "
+
     def __init__(self, proxy_manager):
         self.proxy_manager = proxy_manager
         self.labs_base_url = config.flow_labs_base_url  # https://labs.google/fx/api
         self.api_base_url = config.flow_api_base_url    # https://aisandbox-pa.googleapis.com/v1
         self.timeout = config.flow_timeout
+        # 复用的HTTP会话 (首次使用时创建，保持 keep-alive 连接池)
+        self._session: Optional[AsyncSession] = None
+        self._captcha_session: Optional[AsyncSession] = None
+        # 每个项目预取的下一个reCAPTCHA token (task结果为 (token, 过期时间))
+        self._recaptcha_prefetch: Dict[str, asyncio.Task] = {}
+        self._status_batcher = _StatusBatcher(self)
+
+    def _get_session(self) -> AsyncSession:
+        """获取Flow API复用会话"""
+        if self._session is None:
+            # HTTP/2 下并发请求复用同一条TLS连接
+            http_version = CurlHttpVersion.V2TLS if config.flow_http2 else CurlHttpVersion.V1_1
+            self._session = AsyncSession(
+                impersonate="chrome110",
+                http_version=http_version,
+                timeout=self.timeout,
+                max_clients=config.flow_max_clients
+            )
+        return self._session
+
+    def _get_captcha_session(self) -> AsyncSession:
+        """获取打码平台复用会话"""
+        if self._captcha_session is None:
+            self._captcha_session = AsyncSession(
+                impersonate="chrome110",
+                max_clients=config.flow_max_clients
+            )
+        return self._captcha_session
+
+    async def aclose(self):
+        """关闭复用的HTTP会话"""
+        for task in self._recaptcha_prefetch.values():
+            task.cancel()
+        self._recaptcha_prefetch.clear()
+        for session in (self._session, self._captcha_session):
+            if session is not None:
+                await session.close()
+        self._session = None
+        self._captcha_session = None
 
     async def _make_request(
         self,
@@ -37,30 +180,32 @@ class FlowClient:
         use_st: bool = False,
         st_token: Optional[str] = None,
         use_at: bool = False,
-        at_token: Optional[str] = None
+        at_token: Optional[str] = None,
+        proxy_url: Any = _UNSET
     ) -> Dict[str, Any]:
-        """统一HTTP请求处理"""
-        proxy_url = await self.proxy_manager.get_proxy_url()
+        """统一HTTP请求处理
+
+        proxy_url: 调用方已获取的代理 (None 表示不使用代理)，未传入时从 ProxyManager 读取
+        """
+        if proxy_url is _UNSET:
+            proxy_url = await self.proxy_manager.get_proxy_url()
 
-        if headers is None:
-            headers = {}
+        # 本次请求内只读取一次调试开关
+        debug_enabled = config.debug_enabled
+
+        # 通用请求头
+        headers = {**self._BASE_HEADERS, **headers} if headers else self._BASE_HEADERS.copy()
 
         # ST认证 - 使用Cookie
         if use_st and st_token:
-            headers["Cookie"] = f"__Secure-next-auth.session-token={st_token}"
+            headers["Cookie"] = self._ST_COOKIE_PREFIX + st_token
 
         # AT认证 - 使用Bearer
         if use_at and at_token:
-            headers["authorization"] = f"Bearer {at_token}"
-
-        # 通用请求头
-        headers.update({
-            "Content-Type": "application/json",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-        })
+            headers["authorization"] = self._BEARER_PREFIX + at_token
 
         # Log request
-        if config.debug_enabled:
+        if debug_enabled:
             debug_logger.log_request(
                 method=method,
                 url=url,
@@ -72,68 +217,75 @@ class FlowClient:
         start_time = time.time()
 
         try:
-            async with AsyncSession() as session:
-                if method.upper() == "GET":
-                    response = await session.get(
-                        url,
-                        headers=headers,
-                        proxy=proxy_url,
-                        timeout=self.timeout,
-                        impersonate="chrome110"
-                    )
-                else:  # POST
-                    response = await session.post(
-                        url,
-                        headers=headers,
-                        json=json_data,
-                        proxy=proxy_url,
-                        timeout=self.timeout,
-                        impersonate="chrome110"
-                    )
+            session = self._get_session()
+            if method.upper() == "GET":
+                response = await session.get(
+                    url,
+                    headers=headers,
+                    proxy=proxy_url
+                )
+            else:  # POST
+                response = await session.post(
+                    url,
+                    headers=headers,
+                    data=orjson.dumps(json_data) if json_data is not None else None,
+                    proxy=proxy_url
+                )
+            # 会话在多个账号间共享，不保留响应写入的Cookie，避免ST串号
+            session.cookies.clear()
 
+            # 响应体只解析一次，日志、错误处理和返回值共用结果
+            raw = response.content
+            try:
+                data = orjson.loads(raw)
+                parse_error = None
+            except orjson.JSONDecodeError as e:
+                data = None
+                parse_error = e
+
+            # Log response
+            if debug_enabled:
                 duration_ms = (time.time() - start_time) * 1000
+                debug_logger.log_response(
+                    status_code=response.status_code,
+                    headers=dict(response.headers),
+                    body=data if parse_error is None else raw[:_ERROR_TEXT_LIMIT].decode("utf-8", errors="replace"),
+                    duration_ms=duration_ms
+                )
 
-                # Log response
-                if config.debug_enabled:
-                    debug_logger.log_response(
-                        status_code=response.status_code,
-                        headers=dict(response.headers),
-                        body=response.text,
-                        duration_ms=duration_ms
-                    )
-
-                # 手动检查状态码，抛出自定义异常
-                if response.status_code >= 400:
-                    try:
-                        error_data = response.json()
-                    except:
-                        # 解析JSON失败，使用文本作为错误信息
-                        error_data = {
-                            "error": {
-                                "message": response.text,
-                                "status": f"HTTP_{response.status_code}"
-                            }
+            # 手动检查状态码，抛出自定义异常
+            if response.status_code >= 400:
+                if parse_error is None:
+                    error_data = data
+                else:
+                    # 解析JSON失败，使用文本作为错误信息 (最多4KB，避免大段HTML错误页)
+                    error_data = {
+                        "error": {
+                            "message": raw[:_ERROR_TEXT_LIMIT].decode("utf-8", errors="replace"),
+                            "status": f"HTTP_{response.status_code}"
                         }
-                    raise FlowAPIException(response.status_code, error_data)
+                    }
+                raise FlowAPIException(response.status_code, error_data)
 
-                return response.json()
+            if parse_error is not None:
+                raise parse_error
+            return data
 
         except FlowAPIException:
             # 直接抛出自定义异常，保持状态码信息
             raise
 
         except Exception as e:
-            duration_ms = (time.time() - start_time) * 1000
             error_msg = str(e)
 
-            if config.debug_enabled:
+            if debug_enabled:
                 debug_logger.log_error(
                     error_message=error_msg,
                     status_code=getattr(e, 'status_code', None),
                     response_text=getattr(e, 'response_text', None)
                 )
 
-            raise Exception(f"Flow API request failed: {error_msg}")
+            raise FlowTransportError(f"Flow API request failed: {error_msg}", e) from e
 
     # ========== 认证相关 (使用ST) ==========
 
@@ -208,25 +360,32 @@ class FlowClient:
     async def upload_image(
         self,
         at: str,
-        image_bytes: bytes,
+        image_bytes: Union[bytes, mmap.mmap],
         aspect_ratio: str = "IMAGE_ASPECT_RATIO_LANDSCAPE"
     ) -> str:
-        """上传图片,返回mediaGenerationId"""
+        """上传图片,返回mediaGenerationId
+
+        image_bytes 也可以是本地缓存文件的 mmap，此时直接编码，不整体读入内存
+        """
         if aspect_ratio.startswith("VIDEO_"):
             aspect_ratio = aspect_ratio.replace("VIDEO_", "IMAGE_")
 
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        # 大图编码放到线程池执行，避免阻塞事件循环；编码的同时获取代理配置
+        (image_base64, mime_type), proxy_url = await asyncio.gather(
+            asyncio.get_running_loop().run_in_executor(None, _encode_image, image_bytes),
+            self.proxy_manager.get_proxy_url()
+        )
 
         url = f"{self.api_base_url}:uploadUserImage"
         json_data = {
             "imageInput": {
                 "rawImageBytes": image_base64,
-                "mimeType": "image/jpeg",
+                "mimeType": mime_type,
                 "isUserUploaded": True,
                 "aspectRatio": aspect_ratio
             },
             "clientContext": {
-                "sessionId": self._generate_session_id(),
+                "sessionId": self.make_session_id(),
                 "tool": "ASSET_MANAGER"
             }
         }
@@ -236,12 +395,25 @@ class FlowClient:
             url=url,
             json_data=json_data,
             use_at=True,
-            at_token=at
+            at_token=at,
+            proxy_url=proxy_url
         )
 
         media_id = result["mediaGenerationId"]["mediaGenerationId"]
         return media_id
 
+    # ========== 生成上下文 ==========
+
+    async def prepare_generation_context(self, project_id: str, session_id: Optional[str] = None) -> tuple:
+        """获取一次生成请求所需的 (recaptcha_token, session_id)
+
+        可以在上传参考图的同时提前调用，结果通过 context 参数传给 generate_* 方法；
+        reCAPTCHA token 只能使用一次，每个 context 只用于一次生成请求。
+        session_id 可由 make_session_id() 生成后在同一批生成中共用
+        """
+        recaptcha_token = await self._get_recaptcha_token(project_id) or ""
+        return recaptcha_token, session_id or self.make_session_id()
+
     # ========== 图片生成 (使用AT) - 同步返回 ==========
 
     async def generate_image(
@@ -252,39 +424,38 @@ class FlowClient:
         model_name: str,
         aspect_ratio: str,
         image_inputs: Optional[List[Dict]] = None,
-        count: int = 1
+        count: int = 1,
+        context: Optional[tuple] = None
     ) -> dict:
         """生成图片(同步返回)"""
         url = f"{self.api_base_url}/projects/{project_id}/flowMedia:batchGenerateImages"
 
-        recaptcha_token = await self._get_recaptcha_token(project_id) or ""
-        session_id = self._generate_session_id()
+        recaptcha_token, session_id = context or await self.prepare_generation_context(project_id)
 
-        requests_list = []
-        generated_seeds = []
-        
         if prompt:
             prompt = prompt.encode("unicode-escape").decode("utf-8")
 
-        # Loop to create multiple requests with unique seeds
-        for _ in range(count):
-            seed = random.randint(1, 99999)
-            generated_seeds.append(seed)
-            
-            request_data = {
-                "clientContext": {
-                    "recaptchaToken": recaptcha_token,
-                    "projectId": project_id,
-                    "sessionId": session_id,
-                    "tool": "PINHOLE"
-                },
+        # 一次生成所有 seed，每个 seed 对应一个请求
+        generated_seeds = random.choices(_SEED_RANGE, k=count)
+        image_inputs = image_inputs or []
+        # 各请求的 clientContext 相同，共用同一个 dict
+        request_context = {
+            "recaptchaToken": recaptcha_token,
+            "projectId": project_id,
+            "sessionId": session_id,
+            "tool": "PINHOLE"
+        }
+        requests_list = [
+            {
+                "clientContext": request_context,
                 "seed": seed,
                 "imageModelName": model_name,
                 "imageAspectRatio": aspect_ratio,
                 "prompt": prompt,
-                "imageInputs": image_inputs or []
+                "imageInputs": image_inputs
             }
-            requests_list.append(request_data)
+            for seed in generated_seeds
+        ]
 
         json_data = {
             "clientContext": {
@@ -314,46 +485,14 @@ class FlowClient:
         prompt: str,
         model_key: str,
         aspect_ratio: str,
-        user_paygate_tier: str = "PAYGATE_TIER_ONE"
+        user_paygate_tier: str = "PAYGATE_TIER_ONE",
+        context: Optional[tuple] = None
     ) -> dict:
         """文生视频,返回task_id"""
-        url = f"{self.api_base_url}/video:batchAsyncGenerateVideoText"
-
-        recaptcha_token = await self._get_recaptcha_token(project_id) or ""
-        session_id = self._generate_session_id()
-        scene_id = str(uuid.uuid4())
-
-        json_data = {
-            "clientContext": {
-                "recaptchaToken": recaptcha_token,
-                "sessionId": session_id,
-                "projectId": project_id,
-                "tool": "PINHOLE",
-                "userPaygateTier": user_paygate_tier
-            },
-            "requests": [{
-                "aspectRatio": aspect_ratio,
-                "seed": random.randint(1, 99999),
-                "textInput": {
-                    "prompt": prompt
-                },
-                "videoModelKey": model_key,
-                "metadata": {
-                    "sceneId": scene_id
-                }
-            }]
-        }
-
-        result = await self._make_request(
-            method="POST",
-            url=url,
-            json_data=json_data,
-            use_at=True,
-            at_token=at
+        return await self._generate_video(
+            "text", at, project_id, prompt, model_key, aspect_ratio, user_paygate_tier, context
         )
 
-        return result
-
     async def generate_video_reference_images(
         self,
         at: str,
@@ -362,47 +501,15 @@ class FlowClient:
         model_key: str,
         aspect_ratio: str,
         reference_images: List[Dict],
-        user_paygate_tier: str = "PAYGATE_TIER_ONE"
+        user_paygate_tier: str = "PAYGATE_TIER_ONE",
+        context: Optional[tuple] = None
     ) -> dict:
         """图生视频,返回task_id"""
-        url = f"{self.api_base_url}/video:batchAsyncGenerateVideoReferenceImages"
-
-        recaptcha_token = await self._get_recaptcha_token(project_id) or ""
-        session_id = self._generate_session_id()
-        scene_id = str(uuid.uuid4())
-
-        json_data = {
-            "clientContext": {
-                "recaptchaToken": recaptcha_token,
-                "sessionId": session_id,
-                "projectId": project_id,
-                "tool": "PINHOLE",
-                "userPaygateTier": user_paygate_tier
-            },
-            "requests": [{
-                "aspectRatio": aspect_ratio,
-                "seed": random.randint(1, 99999),
-                "textInput": {
-                    "prompt": prompt
-                },
-                "videoModelKey": model_key,
-                "referenceImages": reference_images,
-                "metadata": {
-                    "sceneId": scene_id
-                }
-            }]
-        }
-
-        result = await self._make_request(
-            method="POST",
-            url=url,
-            json_data=json_data,
-            use_at=True,
-            at_token=at
+        return await self._generate_video(
+            "reference", at, project_id, prompt, model_key, aspect_ratio, user_paygate_tier, context,
+            reference_images=reference_images
         )
 
-        return result
-
     async def generate_video_start_end(
         self,
         at: str,
@@ -412,52 +519,15 @@ class FlowClient:
         aspect_ratio: str,
         start_media_id: str,
         end_media_id: str,
-        user_paygate_tier: str = "PAYGATE_TIER_ONE"
+        user_paygate_tier: str = "PAYGATE_TIER_ONE",
+        context: Optional[tuple] = None
     ) -> dict:
         """收尾帧生成视频,返回task_id"""
-        url = f"{self.api_base_url}/video:batchAsyncGenerateVideoStartAndEndImage"
-
-        recaptcha_token = await self._get_recaptcha_token(project_id) or ""
-        session_id = self._generate_session_id()
-        scene_id = str(uuid.uuid4())
-
-        json_data = {
-            "clientContext": {
-                "recaptchaToken": recaptcha_token,
-                "sessionId": session_id,
-                "projectId": project_id,
-                "tool": "PINHOLE",
-                "userPaygateTier": user_paygate_tier
-            },
-            "requests": [{
-                "aspectRatio": aspect_ratio,
-                "seed": random.randint(1, 99999),
-                "textInput": {
-                    "prompt": prompt
-                },
-                "videoModelKey": model_key,
-                "startImage": {
-                    "mediaId": start_media_id
-                },
-                "endImage": {
-                    "mediaId": end_media_id
-                },
-                "metadata": {
-                    "sceneId": scene_id
-                }
-            }]
-        }
-
-        result = await self._make_request(
-            method="POST",
-            url=url,
-            json_data=json_data,
-            use_at=True,
-            at_token=at
+        return await self._generate_video(
+            "start_end", at, project_id, prompt, model_key, aspect_ratio, user_paygate_tier, context,
+            start_media_id=start_media_id, end_media_id=end_media_id
         )
 
-        return result
-
     async def generate_video_start_image(
         self,
         at: str,
@@ -466,37 +536,45 @@ class FlowClient:
         model_key: str,
         aspect_ratio: str,
         start_media_id: str,
-        user_paygate_tier: str = "PAYGATE_TIER_ONE"
+        user_paygate_tier: str = "PAYGATE_TIER_ONE",
+        context: Optional[tuple] = None
     ) -> dict:
         """仅首帧生成视频,返回task_id"""
-        url = f"{self.api_base_url}/video:batchAsyncGenerateVideoStartAndEndImage"
+        return await self._generate_video(
+            "start_end", at, project_id, prompt, model_key, aspect_ratio, user_paygate_tier, context,
+            start_media_id=start_media_id
+        )
 
-        recaptcha_token = await self._get_recaptcha_token(project_id) or ""
-        session_id = self._generate_session_id()
-        scene_id = str(uuid.uuid4())
+    async def _generate_video(
+        self,
+        kind: str,
+        at: str,
+        project_id: str,
+        prompt: str,
+        model_key: str,
+        aspect_ratio: str,
+        user_paygate_tier: str,
+        context: Optional[tuple],
+        reference_images: Optional[List[Dict]] = None,
+        start_media_id: Optional[str] = None,
+        end_media_id: Optional[str] = None
+    ) -> dict:
+        """视频生成统一入口，kind 决定接口 (见 _VIDEO_ENDPOINTS)"""
+        url = self.api_base_url + _VIDEO_ENDPOINTS[kind]
+
+        recaptcha_token, session_id = context or await self.prepare_generation_context(project_id)
+
+        request = self._video_request(aspect_ratio, prompt, model_key)
+        if reference_images is not None:
+            request["referenceImages"] = reference_images
+        if start_media_id is not None:
+            request["startImage"] = {"mediaId": start_media_id}
+        if end_media_id is not None:
+            request["endImage"] = {"mediaId": end_media_id}
 
         json_data = {
-            "clientContext": {
-                "recaptchaToken": recaptcha_token,
-                "sessionId": session_id,
-                "projectId": project_id,
-                "tool": "PINHOLE",
-                "userPaygateTier": user_paygate_tier
-            },
-            "requests": [{
-                "aspectRatio": aspect_ratio,
-                "seed": random.randint(1, 99999),
-                "textInput": {
-                    "prompt": prompt
-                },
-                "videoModelKey": model_key,
-                "startImage": {
-                    "mediaId": start_media_id
-                },
-                "metadata": {
-                    "sceneId": scene_id
-                }
-            }]
+            "clientContext": self._video_client_context(recaptcha_token, session_id, project_id, user_paygate_tier),
+            "requests": [request]
         }
 
         result = await self._make_request(
@@ -509,6 +587,37 @@ class FlowClient:
 
         return result
 
+    @staticmethod
+    def _video_client_context(
+        recaptcha_token: str,
+        session_id: str,
+        project_id: str,
+        user_paygate_tier: str
+    ) -> dict:
+        """视频生成请求的 clientContext"""
+        return {
+            "recaptchaToken": recaptcha_token,
+            "sessionId": session_id,
+            "projectId": project_id,
+            "tool": "PINHOLE",
+            "userPaygateTier": user_paygate_tier
+        }
+
+    @staticmethod
+    def _video_request(aspect_ratio: str, prompt: str, model_key: str) -> dict:
+        """视频生成单个请求的公共字段，调用方再补充图片相关字段"""
+        return {
+            "aspectRatio": aspect_ratio,
+            "seed": random.choice(_SEED_RANGE),
+            "textInput": {
+                "prompt": prompt
+            },
+            "videoModelKey": model_key,
+            "metadata": {
+                "sceneId": str(uuid.uuid4())
+            }
+        }
+
     # ========== 任务轮询 (使用AT) ==========
 
     async def check_video_status(self, at: str, operations: List[Dict]) -> dict:
@@ -529,6 +638,10 @@ class FlowClient:
 
         return result
 
+    async def poll_video_status(self, at: str, operation: Dict) -> dict:
+        """查询单个视频任务状态，并发调用会被合并为一次批量查询"""
+        return await self._status_batcher.poll_one(at, operation)
+
     # ========== 媒体删除 (使用ST) ==========
 
     async def delete_media(self, st: str, media_names: List[str]):
@@ -550,16 +663,47 @@ class FlowClient:
 
     # ========== 辅助方法 ==========
 
-    def _generate_session_id(self) -> str:
-        """生成sessionId: ;timestamp"""
-        return f";{int(time.time() * 1000)}"
+    @staticmethod
+    def make_session_id() -> str:
+        """生成sessionId: ;毫秒时间戳，同一批生成可共用一个"""
+        return f";{time.time_ns() // 1_000_000}"
 
     def _generate_scene_id(self) -> str:
         """生成sceneId: UUID"""
         return str(uuid.uuid4())
 
     async def _get_recaptcha_token(self, project_id: str) -> Optional[str]:
-        """获取reCAPTCHA token - 支持多种方式"""
+        """获取reCAPTCHA token，优先使用该项目预取的token
+
+        token 只能使用一次，预取结果取出即删除；开启 captcha.prefetch 时
+        每次取走后在后台为该项目再解一个，供下一次生成直接使用
+        """
+        token = None
+        pending = self._recaptcha_prefetch.pop(project_id, None)
+        if pending is not None:
+            try:
+                token, expires_at = await pending
+                if time.time() >= expires_at:
+                    token = None
+            except Exception:
+                token = None
+
+        if not token:
+            token = await self._solve_recaptcha(project_id)
+
+        if token and config.captcha_prefetch:
+            self._recaptcha_prefetch[project_id] = asyncio.create_task(
+                self._prefetch_recaptcha(project_id)
+            )
+        return token
+
+    async def _prefetch_recaptcha(self, project_id: str) -> tuple:
+        """后台预取reCAPTCHA token，返回 (token, 过期时间)"""
+        token = await self._solve_recaptcha(project_id)
+        return token, time.time() + _RECAPTCHA_TTL
+
+    async def _solve_recaptcha(self, project_id: str) -> Optional[str]:
+        """通过打码平台解reCAPTCHA - 支持多种方式"""
         
         # CapSolver
         if config.captcha_method == "capsolver":
@@ -574,47 +718,48 @@ class FlowClient:
             page_action = "FLOW_GENERATION"
             
             try:
-                async with AsyncSession() as session:
-                    create_url = f"{base_url}/createTask"
-                    create_data = {
-                        "clientKey": client_key,
-                        "task": {
-                            "type": "ReCaptchaV3EnterpriseTaskProxyLess",
-                            "websiteURL": website_url,
-                            "websiteKey": website_key,
-                            "pageAction": page_action
-                        }
+                session = self._get_captcha_session()
+                create_url = f"{base_url}/createTask"
+                create_data = {
+                    "clientKey": client_key,
+                    "task": {
+                        "type": "ReCaptchaV3EnterpriseTaskProxyLess",
+                        "websiteURL": website_url,
+                        "websiteKey": website_key,
+                        "pageAction": page_action
                     }
+                }
+                
+                result = await session.post(create_url, data=orjson.dumps(create_data), headers=_JSON_HEADERS)
+                result_json = orjson.loads(result.content)
+                task_id = result_json.get('taskId')
+                
+                debug_logger.log_info(f"[reCAPTCHA] CapSolver created task_id: {task_id}")
+                
+                if not task_id:
+                    return None
+                
+                get_url = f"{base_url}/getTaskResult"
+                # 轮询请求体不变，只序列化一次
+                get_data = orjson.dumps({
+                    "clientKey": client_key,
+                    "taskId": task_id
+                })
+                for i in range(40):
+                    result = await session.post(get_url, data=get_data, headers=_JSON_HEADERS)
+                    result_json = orjson.loads(result.content)
                     
-                    result = await session.post(create_url, json=create_data, impersonate="chrome110")
-                    result_json = result.json()
-                    task_id = result_json.get('taskId')
+                    debug_logger.log_info(f"[reCAPTCHA] CapSolver polling #{i+1}: {result_json}")
                     
-                    debug_logger.log_info(f"[reCAPTCHA] CapSolver created task_id: {task_id}")
+                    status = result_json.get('status')
+                    if status == 'ready':
+                        return result_json.get('solution', {}).get('gRecaptchaResponse')
                     
-                    if not task_id:
+                    if status == 'failed':
                         return None
-                    
-                    get_url = f"{base_url}/getTaskResult"
-                    for i in range(40):
-                        get_data = {
-                            "clientKey": client_key,
-                            "taskId": task_id
-                        }
-                        result = await session.post(get_url, json=get_data, impersonate="chrome110")
-                        result_json = result.json()
-                        
-                        debug_logger.log_info(f"[reCAPTCHA] CapSolver polling #{i+1}: {result_json}")
                         
-                        status = result_json.get('status')
-                        if status == 'ready':
-                            return result_json.get('solution', {}).get('gRecaptchaResponse')
-                        
-                        if status == 'failed':
-                            return None
-                            
-                        time.sleep(1)
-                    return None
+                    await asyncio.sleep(1)
+                return None
             except Exception as e:
                 debug_logger.log_error(f"[reCAPTCHA] CapSolver error: {str(e)}")
                 return None
@@ -631,47 +776,49 @@ class FlowClient:
         page_action = "FLOW_GENERATION"
 
         try:
-            async with AsyncSession() as session:
-                create_url = f"{base_url}/createTask"
-                create_data = {
-                    "clientKey": client_key,
-                    "task": {
-                        "websiteURL": website_url,
-                        "websiteKey": website_key,
-                        "type": "RecaptchaV3TaskProxylessM1",
-                        "pageAction": page_action
-                    }
+            session = self._get_captcha_session()
+            create_url = f"{base_url}/createTask"
+            create_data = {
+                "clientKey": client_key,
+                "task": {
+                    "websiteURL": website_url,
+                    "websiteKey": website_key,
+                    "type": "RecaptchaV3TaskProxylessM1",
+                    "pageAction": page_action
                 }
+            }
 
-                result = await session.post(create_url, json=create_data, impersonate="chrome110")
-                result_json = result.json()
-                task_id = result_json.get('taskId')
+            result = await session.post(create_url, data=orjson.dumps(create_data), headers=_JSON_HEADERS)
+            result_json = orjson.loads(result.content)
+            task_id = result_json.get('taskId')
 
-                debug_logger.log_info(f"[reCAPTCHA] created task_id: {task_id}")
+            debug_logger.log_info(f"[reCAPTCHA] created task_id: {task_id}")
 
-                if not task_id:
-                    return None
+            if not task_id:
+                return None
 
-                get_url = f"{base_url}/getTaskResult"
-                for i in range(40):
-                    get_data = {
-                        "clientKey": client_key,
-                        "taskId": task_id
-                    }
-                    result = await session.post(get_url, json=get_data, impersonate="chrome110")
-                    result_json = result.json()
+            get_url = f"{base_url}/getTaskResult"
+            # 轮询请求体不变，只序列化一次
+            get_data = orjson.dumps({
+                "clientKey": client_key,
+                "taskId": task_id
+            })
+            for i in range(40):
+                result = await session.post(get_url, data=get_data, headers=_JSON_HEADERS)
+                result_json = orjson.loads(result.content)
 
-                    debug_logger.log_info(f"[reCAPTCHA] polling #{i+1}: {result_json}")
+                debug_logger.log_info(f"[reCAPTCHA] polling #{i+1}: {result_json}")
 
-                    solution = result_json.get('solution', {})
-                    response = solution.get('gRecaptchaResponse')
+                solution = result_json.get('solution', {})
+                response = solution.get('gRecaptchaResponse')
 
-                    if response:
-                        return response
+                if response:
+                    return response
 
-                    time.sleep(3)
+                # 退避轮询: 1.5s 起步，逐步增加到 5s 封顶
+                await asyncio.sleep(min(1.5 * 1.3 ** i, 5))
 
-                return None
+            return None
 
         except Exception as e:
             debug_logger.log_error(f"[reCAPTCHA] error: {str(e)}")
@@ -2,8 +2,10 @@
 import asyncio
 import base64
 import json
+import mmap
 import time
-from typing import Optional, AsyncGenerator, List, Dict, Any
+from typing import Optional, AsyncGenerator, List, Dict, Any, Union
+from curl_cffi.requests import AsyncSession
 from ..core.logger import debug_logger
 from ..core.config import config
 from ..core.models import Task, RequestLog
@@ -332,6 +334,25 @@ class GenerationHandler:
             default_timeout=config.cache_timeout,
             proxy_manager=proxy_manager
         )
+        self._image_session: Optional[AsyncSession] = None
+
+    def get_image_session(self) -> AsyncSession:
+        """获取复用的图片下载会话 (首次调用时创建，保持连接池)"""
+        if self._image_session is None:
+            self._image_session = AsyncSession(
+                impersonate="chrome110",
+                verify=False,
+                timeout=30,
+                # 流式下载在 aclose() 前一直占用句柄，默认的 10 个不够并发使用
+                max_clients=config.flow_max_clients
+            )
+        return self._image_session
+
+    async def close(self):
+        """关闭复用的HTTP会话"""
+        if self._image_session is not None:
+            await self._image_session.close()
+            self._image_session = None
 
     async def check_token_availability(self, is_image: bool, is_video: bool) -> bool:
         """检查Token可用性
@@ -353,7 +374,7 @@ class GenerationHandler:
         self,
         model: str,
         prompt: str,
-        images: Optional[List[bytes]] = None,
+        images: Optional[List[Union[bytes, mmap.mmap]]] = None,
         stream: bool = False,
         n: int = 1
     ) -> AsyncGenerator:
@@ -362,7 +383,7 @@ class GenerationHandler:
         Args:
             model: 模型名称
             prompt: 提示词
-            images: 图片列表 (bytes格式)
+            images: 图片列表 (bytes格式，或本地缓存文件的 mmap)
             stream: 是否流式输出
         """
         start_time = time.time()
@@ -562,7 +583,7 @@ class GenerationHandler:
         project_id: str,
         model_config: dict,
         prompt: str,
-        images: Optional[List[bytes]],
+        images: Optional[List[Union[bytes, mmap.mmap]]],
         stream: bool,
         count: int
     ) -> AsyncGenerator:
@@ -574,10 +595,15 @@ class GenerationHandler:
                 yield self._create_error_response("图片并发限制已达上限")
                 return
 
+        context_task = None
         try:
             # 上传图片 (如果有)
             image_inputs = []
             if images and len(images) > 0:
+                # 上传参考图的同时获取reCAPTCHA
+                context_task = asyncio.create_task(
+                    self.flow_client.prepare_generation_context(project_id)
+                )
                 if stream:
                     yield self._create_stream_chunk(f"上传 {len(images)} 张参考图片...\n")
 
@@ -607,7 +633,8 @@ class GenerationHandler:
                 model_name=model_config["model_name"],
                 aspect_ratio=model_config["aspect_ratio"],
                 image_inputs=image_inputs,
-                count=count
+                count=count,
+                context=await context_task if context_task else None
             )
 
             # 提取URL
@@ -659,6 +686,8 @@ class GenerationHandler:
                 )
 
         finally:
+            if context_task and not context_task.done():
+                context_task.cancel()
             # 释放并发槽位
             if self.concurrency_manager:
                 await self.concurrency_manager.release_image(token.id)
@@ -669,7 +698,7 @@ class GenerationHandler:
         project_id: str,
         model_config: dict,
         prompt: str,
-        images: Optional[List[bytes]],
+        images: Optional[List[Union[bytes, mmap.mmap]]],
         stream: bool
     ) -> AsyncGenerator:
         """处理视频生成 (异步轮询)"""
@@ -680,6 +709,7 @@ class GenerationHandler:
                 yield self._create_error_response("视频并发限制已达上限")
                 return
 
+        context_task = None
         try:
             # 获取模型类型和配置
             video_type = model_config.get("video_type")
@@ -720,6 +750,12 @@ class GenerationHandler:
             end_media_id = None
             reference_images = []
 
+            # 上传图片的同时获取reCAPTCHA
+            if images:
+                context_task = asyncio.create_task(
+                    self.flow_client.prepare_generation_context(project_id)
+                )
+
             # I2V: 首尾帧处理
             if video_type == "i2v" and images:
                 if image_count == 1:
@@ -762,6 +798,8 @@ class GenerationHandler:
             if stream:
                 yield self._create_stream_chunk("提交视频生成任务...\n")
 
+            context = await context_task if context_task else None
+
             # I2V: 首尾帧生成
             if video_type == "i2v" and start_media_id:
                 if end_media_id:
@@ -774,7 +812,8 @@ class GenerationHandler:
                         aspect_ratio=model_config["aspect_ratio"],
                         start_media_id=start_media_id,
                         end_media_id=end_media_id,
-                        user_paygate_tier=token.user_paygate_tier or "PAYGATE_TIER_ONE"
+                        user_paygate_tier=token.user_paygate_tier or "PAYGATE_TIER_ONE",
+                        context=context
                     )
                 else:
                     # 只有首帧
@@ -785,7 +824,8 @@ class GenerationHandler:
                         model_key=model_config["model_key"],
                         aspect_ratio=model_config["aspect_ratio"],
                         start_media_id=start_media_id,
-                        user_paygate_tier=token.user_paygate_tier or "PAYGATE_TIER_ONE"
+                        user_paygate_tier=token.user_paygate_tier or "PAYGATE_TIER_ONE",
+                        context=context
                     )
 
             # R2V: 多图生成
@@ -797,7 +837,8 @@ class GenerationHandler:
                     model_key=model_config["model_key"],
                     aspect_ratio=model_config["aspect_ratio"],
                     reference_images=reference_images,
-                    user_paygate_tier=token.user_paygate_tier or "PAYGATE_TIER_ONE"
+                    user_paygate_tier=token.user_paygate_tier or "PAYGATE_TIER_ONE",
+                    context=context
                 )
 
             # T2V 或 R2V无图: 纯文本生成
@@ -808,7 +849,8 @@ class GenerationHandler:
                     prompt=prompt,
                     model_key=model_config["model_key"],
                     aspect_ratio=model_config["aspect_ratio"],
-                    user_paygate_tier=token.user_paygate_tier or "PAYGATE_TIER_ONE"
+                    user_paygate_tier=token.user_paygate_tier or "PAYGATE_TIER_ONE",
+                    context=context
                 )
 
             # 获取task_id和operations
@@ -840,6 +882,8 @@ class GenerationHandler:
                 yield chunk
 
         finally:
+            if context_task and not context_task.done():
+                context_task.cancel()
             # 释放并发槽位
             if self.concurrency_manager:
                 await self.concurrency_manager.release_video(token.id)
@@ -859,7 +903,7 @@ class GenerationHandler:
             await asyncio.sleep(poll_interval)
 
             try:
-                result = await self.flow_client.check_video_status(token.at, operations)
+                result = await self.flow_client.poll_video_status(token.at, operations[0])
                 checked_operations = result.get("operations", [])
 
                 if not checked_operations:
@@ -8,10 +8,12 @@ class ProxyManager:
 
     def __init__(self, db: Database):
         self.db = db
+        # 代理配置缓存，仅在 update_proxy_config 时失效
+        self._config: Optional[ProxyConfig] = None
 
     async def get_proxy_url(self) -> Optional[str]:
         """Get proxy URL if enabled, otherwise return None"""
-        config = await self.db.get_proxy_config()
+        config = await self.get_proxy_config()
         if config and config.enabled and config.proxy_url:
             return config.proxy_url
         return None
@@ -19,7 +21,10 @@ class ProxyManager:
     async def update_proxy_config(self, enabled: bool, proxy_url: Optional[str]):
         """Update proxy configuration"""
         await self.db.update_proxy_config(enabled, proxy_url)
+        self._config = None
 
     async def get_proxy_config(self) -> ProxyConfig:
         """Get proxy configuration"""
-        return await self.db.get_proxy_config()
+        if self._config is None:
+            self._config = await self.db.get_proxy_config()
+        return self._config
@@ -1,13 +1,55 @@
 """Token manager for Flow2API with AT auto-refresh"""
 import asyncio
+import sys
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List
+from typing import Any, Dict, Optional, List, Tuple
+from ..core.config import config
 from ..core.database import Database
-from ..core.models import Token, Project
+from ..core.models import Token, Project, AdminConfig
 from ..core.logger import debug_logger
 from .flow_client import FlowClient
 from .proxy_manager import ProxyManager
 
+# AT 剩余有效期低于该值 (秒) 时在后台提前刷新，请求不等待
+_AT_REFRESH_THRESHOLD = 3600
+# 每个 token 一把刷新锁，超过上限时淘汰最久未使用且空闲的锁
+_REFRESH_LOCKS_MAX = 1024
+# admin_config 进程内缓存时间 (秒)
+_ADMIN_CONFIG_TTL = 30
+# is_at_valid 使用的 AT 过期时间缓存时间 (秒)
+_TOKEN_META_TTL = 10
+_FROMISOFORMAT_Z = sys.version_info >= (3, 11)
+# _refresh_at 未传入调用方看到的AT时: 无条件刷新 (管理端手动刷新)
+_FORCE_REFRESH = object()
+# 使用统计后台批量写入: 单批最多条数 / 收集窗口 (秒)
+_USAGE_BATCH_MAX = 64
+_USAGE_BATCH_WINDOW = 0.1
+
+
+def parse_expires(expires: Optional[str]) -> Optional[datetime]:
+    """解析 ST 转 AT 返回的 expires (ISO 8601) 为 UTC aware datetime，无法解析时返回 None"""
+    if not expires:
+        return None
+    try:
+        # Python 3.11+ 的 fromisoformat 可直接解析 'Z' 结尾
+        if _FROMISOFORMAT_Z:
+            parsed = datetime.fromisoformat(expires)
+        else:
+            parsed = datetime.fromisoformat(expires.replace('Z', '+00:00'))
+    except (ValueError, TypeError):
+        return None
+    # 无时区信息时按 UTC 处理
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _default_project_name() -> str:
+    """自动生成的项目名称 (UTC 时间)"""
+    return datetime.now(timezone.utc).strftime("%b %d - %H:%M")
+
 
 class TokenManager:
     """Token lifecycle manager with AT auto-refresh"""
@@ -15,7 +57,52 @@ class TokenManager:
     def __init__(self, db: Database, flow_client: FlowClient):
         self.db = db
         self.flow_client = flow_client
-        self._lock = asyncio.Lock()
+        self._refresh_locks: "OrderedDict[int, asyncio.Lock]" = OrderedDict()
+        # 进行中的 AT 刷新任务，同一 token 的并发调用共享同一个结果
+        self._refresh_tasks: Dict[int, "asyncio.Task[Optional[str]]"] = {}
+        # (加载时间, AdminConfig)，管理端修改配置时清空
+        self._admin_config_cache: Optional[Tuple[float, AdminConfig]] = None
+        # token_id -> (加载时间, AT过期时间)，写 token 时清除
+        self._token_meta_cache: Dict[int, Tuple[float, datetime]] = {}
+        # record_usage 事件队列 (token_id, is_video, used_at)，由后台任务批量写库；首次使用时创建
+        self._usage_queue: Optional[asyncio.Queue] = None
+        # (db.tokens_revision, 活跃token列表)，修订号变化即失效
+        self._active_tokens_cache: Optional[Tuple[int, List[Token]]] = None
+        self._usage_worker: Optional[asyncio.Task] = None
+
+    def _get_refresh_lock(self, token_id: int) -> asyncio.Lock:
+        """获取 token 专属的刷新锁 (同步方法，事件循环内无需额外加锁)"""
+        lock = self._refresh_locks.get(token_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._refresh_locks[token_id] = lock
+            if len(self._refresh_locks) > _REFRESH_LOCKS_MAX:
+                for old_id, old_lock in list(self._refresh_locks.items()):
+                    if len(self._refresh_locks) <= _REFRESH_LOCKS_MAX:
+                        break
+                    if not old_lock.locked():
+                        del self._refresh_locks[old_id]
+        else:
+            self._refresh_locks.move_to_end(token_id)
+        return lock
+
+    async def _get_admin_config_cached(self) -> AdminConfig:
+        """读取 admin_config，结果缓存 _ADMIN_CONFIG_TTL 秒"""
+        cached = self._admin_config_cache
+        now = time.monotonic()
+        if cached is not None and now - cached[0] < _ADMIN_CONFIG_TTL:
+            return cached[1]
+        admin_config = await self.db.get_admin_config()
+        self._admin_config_cache = (now, admin_config)
+        return admin_config
+
+    def _invalidate_token_meta(self, token_id: int):
+        """清除 is_at_valid 的 token 缓存"""
+        self._token_meta_cache.pop(token_id, None)
+
+    def invalidate_admin_config_cache(self):
+        """清空 admin_config 缓存 (管理端修改配置后调用)"""
+        self._admin_config_cache = None
 
     # ========== Token CRUD ==========
     async def get_all_tokens(self) -> List[Token]:
@@ -23,8 +110,15 @@ class TokenManager:
         return await self.db.get_all_tokens()
 
     async def get_active_tokens(self) -> List[Token]:
-        """Get all active tokens"""
-        return await self.db.get_active_tokens()
+        """Get all active tokens (tokens 表未变更时直接返回缓存)"""
+        revision = self.db.tokens_revision
+        cached = self._active_tokens_cache
+        if cached is not None and cached[0] == revision:
+            return list(cached[1])
+        tokens = await self.db.get_active_tokens()
+        # 使用查询前读取的修订号: 查询期间若有写入，下次调用会重新查询
+        self._active_tokens_cache = (revision, tokens)
+        return list(tokens)
 
     async def get_token(self, token_id: int) -> Optional[Token]:
         """Get token by ID"""
@@ -33,17 +127,19 @@ class TokenManager:
     async def delete_token(self, token_id: int):
         """Delete token"""
         await self.db.delete_token(token_id)
+        self._invalidate_token_meta(token_id)
 
     async def enable_token(self, token_id: int):
         """Enable a token and reset error count"""
-        # Enable the token
-        await self.db.update_token(token_id, is_active=True)
-        # Reset error count when enabling (only reset total error_count, keep today_error_count)
-        await self.db.reset_error_count(token_id)
+        # Enable the token and reset consecutive error count in one transaction
+        # (keep error_count and today_error_count)
+        await self.db.enable_token(token_id)
+        self._invalidate_token_meta(token_id)
 
     async def disable_token(self, token_id: int):
         """Disable a token"""
         await self.db.update_token(token_id, is_active=False)
+        self._invalidate_token_meta(token_id)
 
     # ========== Token添加 (支持Project创建) ==========
 
@@ -89,12 +185,7 @@ class TokenManager:
             name = user_info.get("name", email.split("@")[0] if email else "")
 
             # 解析过期时间
-            at_expires = None
-            if expires:
-                try:
-                    at_expires = datetime.fromisoformat(expires.replace('Z', '+00:00'))
-                except:
-                    pass
+            at_expires = parse_expires(expires)
 
         except Exception as e:
             raise ValueError(f"ST转AT失败: {str(e)}")
@@ -114,14 +205,12 @@ class TokenManager:
             debug_logger.log_info(f"[ADD_TOKEN] Using provided project_id: {project_id}")
             if not project_name:
                 # 如果没有提供project_name,生成一个
-                now = datetime.now()
-                project_name = now.strftime("%b %d - %H:%M")
+                project_name = _default_project_name()
         else:
             # 用户没有提供project_id,需要创建新项目
             if not project_name:
                 # 自动生成项目名称
-                now = datetime.now()
-                project_name = now.strftime("%b %d - %H:%M")
+                project_name = _default_project_name()
 
             try:
                 project_id = await self.flow_client.create_project(st, project_name)
@@ -211,12 +300,7 @@ class TokenManager:
             # 检查token是否过期
             is_expired = False
             if token.at_expires:
-                now = datetime.now(timezone.utc)
-                if token.at_expires.tzinfo is None:
-                    at_expires_aware = token.at_expires.replace(tzinfo=timezone.utc)
-                else:
-                    at_expires_aware = token.at_expires
-                is_expired = at_expires_aware <= now
+                is_expired = token.at_expires <= datetime.now(timezone.utc)
 
             # 如果未过期，清空429禁用状态
             if not is_expired:
@@ -226,6 +310,7 @@ class TokenManager:
 
         if update_fields:
             await self.db.update_token(token_id, **update_fields)
+            self._invalidate_token_meta(token_id)
 
     # ========== AT自动刷新逻辑 (核心) ==========
 
@@ -236,47 +321,121 @@ class TokenManager:
             True if AT is valid or refreshed successfully
             False if AT cannot be refreshed
         """
+        # 本次检查统一使用同一个当前时间
+        now = datetime.now(timezone.utc)
+
+        # 缓存命中且AT离刷新窗口还远: 无需读库
+        cached = self._token_meta_cache.get(token_id)
+        if cached is not None and time.monotonic() - cached[0] < _TOKEN_META_TTL:
+            if (cached[1] - now).total_seconds() >= self._at_refresh_threshold():
+                return True
+
         token = await self.db.get_token(token_id)
         if not token:
             return False
 
+        return await self._ensure_valid_at(token, now) is not None
+
+    @staticmethod
+    def _at_blocking_threshold() -> float:
+        """AT 剩余有效期低于该值 (秒) 时同步刷新
+
+        取单次任务持有同一个AT的最长时间 (视频轮询总时长、图片/视频超时)，
+        避免任务进行中AT过期
+        """
+        return max(
+            config.max_poll_attempts * config.poll_interval,
+            config.image_timeout,
+            config.video_timeout,
+        )
+
+    @classmethod
+    def _at_refresh_threshold(cls) -> float:
+        """AT 剩余有效期低于该值 (秒) 时后台提前刷新"""
+        return max(_AT_REFRESH_THRESHOLD, cls._at_blocking_threshold())
+
+    async def _ensure_valid_at(self, token: Token, now: Optional[datetime] = None) -> Optional[str]:
+        """检查已读取的 token 的AT,必要时刷新
+
+        Args:
+            token: 已读取的token
+            now: 调用方已取得的当前UTC时间 (可选)
+
+        Returns:
+            可用的AT (可能是刷新后的新AT)，无法刷新时返回None
+        """
+        token_id = token.id
+
         # 如果AT不存在,需要刷新
         if not token.at:
             debug_logger.log_info(f"[AT_CHECK] Token {token_id}: AT不存在,需要刷新")
-            return await self._refresh_at(token_id)
+            return await self._refresh_at(token_id, token.at)
 
         # 如果没有过期时间,假设需要刷新
         if not token.at_expires:
             debug_logger.log_info(f"[AT_CHECK] Token {token_id}: AT过期时间未知,尝试刷新")
-            return await self._refresh_at(token_id)
+            return await self._refresh_at(token_id, token.at)
 
         # 检查是否即将过期 (提前1小时刷新)
-        now = datetime.now(timezone.utc)
-        # 确保at_expires也是timezone-aware
-        if token.at_expires.tzinfo is None:
-            at_expires_aware = token.at_expires.replace(tzinfo=timezone.utc)
-        else:
-            at_expires_aware = token.at_expires
-
-        time_until_expiry = at_expires_aware - now
-
-        if time_until_expiry.total_seconds() < 3600:  # 1 hour (3600 seconds)
-            debug_logger.log_info(f"[AT_CHECK] Token {token_id}: AT即将过期 (剩余 {time_until_expiry.total_seconds():.0f} 秒),需要刷新")
-            return await self._refresh_at(token_id)
+        # at_expires 在 Token 模型中已统一为 UTC aware
+        if now is None:
+            now = datetime.now(timezone.utc)
+        remaining = (token.at_expires - now).total_seconds()
+
+        # 剩余有效期不够一次生成任务使用: 必须等待刷新完成
+        if remaining < self._at_blocking_threshold():
+            debug_logger.log_info(f"[AT_CHECK] Token {token_id}: AT即将过期 (剩余 {remaining:.0f} 秒),需要刷新")
+            return await self._refresh_at(token_id, token.at)
+
+        # 仍然有效但进入刷新窗口 (提前1小时): 后台刷新，当前请求继续使用旧AT
+        if remaining < self._at_refresh_threshold():
+            if token_id not in self._refresh_tasks:
+                debug_logger.log_info(f"[AT_CHECK] Token {token_id}: AT剩余 {remaining:.0f} 秒,后台刷新")
+            self._get_refresh_task(token_id, token.at)
 
         # AT有效
-        return True
+        self._token_meta_cache[token_id] = (time.monotonic(), token.at_expires)
+        return token.at
 
-    async def _refresh_at(self, token_id: int) -> bool:
-        """内部方法: 刷新AT
+    async def _refresh_at(self, token_id: int, observed_at: Any = _FORCE_REFRESH) -> Optional[str]:
+        """内部方法: 刷新AT (同一 token 的并发刷新合并为一个任务)
+
+        Args:
+            token_id: Token ID
+            observed_at: 调用方读到的AT；拿到锁后库中AT已不同则说明已被刷新，直接复用。
+                不传时无条件刷新
 
         Returns:
-            True if refresh successful, False otherwise
+            刷新后的AT, 失败返回None
         """
-        async with self._lock:
+        # shield: 单个调用方被取消时不影响其他等待者
+        return await asyncio.shield(self._get_refresh_task(token_id, observed_at))
+
+    def _get_refresh_task(self, token_id: int, observed_at: Any = _FORCE_REFRESH) -> "asyncio.Task[Optional[str]]":
+        """获取进行中的刷新任务，不存在时创建"""
+        task = self._refresh_tasks.get(token_id)
+        if task is None:
+            task = asyncio.create_task(self._do_refresh_at(token_id, observed_at))
+            self._refresh_tasks[token_id] = task
+            task.add_done_callback(lambda t: self._on_refresh_done(token_id, t))
+        return task
+
+    def _on_refresh_done(self, token_id: int, task: "asyncio.Task[Optional[str]]"):
+        """刷新任务结束: 移出任务表，并取走后台任务的异常避免未处理告警"""
+        self._refresh_tasks.pop(token_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            debug_logger.log_error(f"[AT_REFRESH] Token {token_id}: 刷新任务异常 - {task.exception()}")
+
+    async def _do_refresh_at(self, token_id: int, observed_at: Any = _FORCE_REFRESH) -> Optional[str]:
+        """执行AT刷新，返回新AT"""
+        async with self._get_refresh_lock(token_id):
             token = await self.db.get_token(token_id)
             if not token:
-                return False
+                return None
+
+            # 拿到锁后再检查一次：AT 与调用方读到的不同，说明已被并发请求刷新过
+            if observed_at is not _FORCE_REFRESH and token.at and token.at != observed_at:
+                return token.at
 
             try:
                 debug_logger.log_info(f"[AT_REFRESH] Token {token_id}: 开始刷新AT...")
@@ -287,40 +446,35 @@ class TokenManager:
                 expires = result.get("expires")
 
                 # 解析过期时间
-                new_at_expires = None
-                if expires:
-                    try:
-                        new_at_expires = datetime.fromisoformat(expires.replace('Z', '+00:00'))
-                    except:
-                        pass
-
-                # 更新数据库
+                new_at_expires = parse_expires(expires)
+
+                # 同时刷新credits (失败时保留原值)
+                new_credits = None
+                try:
+                    credits_result = await self.flow_client.get_credits(new_at)
+                    new_credits = credits_result.get("credits", 0)
+                except:
+                    pass
+
+                # 更新数据库 (AT、过期时间、credits 一次写入)
                 await self.db.update_token(
                     token_id,
                     at=new_at,
-                    at_expires=new_at_expires
+                    at_expires=new_at_expires,
+                    credits=new_credits
                 )
+                self._invalidate_token_meta(token_id)
 
                 debug_logger.log_info(f"[AT_REFRESH] Token {token_id}: AT刷新成功")
                 debug_logger.log_info(f"  - 新过期时间: {new_at_expires}")
 
-                # 同时刷新credits
-                try:
-                    credits_result = await self.flow_client.get_credits(new_at)
-                    await self.db.update_token(
-                        token_id,
-                        credits=credits_result.get("credits", 0)
-                    )
-                except:
-                    pass
-
-                return True
+                return new_at
 
             except Exception as e:
                 debug_logger.log_error(f"[AT_REFRESH] Token {token_id}: AT刷新失败 - {str(e)}")
                 # 刷新失败,禁用Token
                 await self.disable_token(token_id)
-                return False
+                return None
 
     async def ensure_project_exists(self, token_id: int) -> str:
         """确保Token有可用的Project
@@ -337,8 +491,7 @@ class TokenManager:
             return token.current_project_id
 
         # 创建新Project
-        now = datetime.now()
-        project_name = now.strftime("%b %d - %H:%M")
+        project_name = _default_project_name()
 
         try:
             project_id = await self.flow_client.create_project(token.st, project_name)
@@ -367,13 +520,54 @@ class TokenManager:
     # ========== Token使用统计 ==========
 
     async def record_usage(self, token_id: int, is_video: bool = False):
-        """Record token usage"""
-        await self.db.update_token(token_id, use_count=1, last_used_at=datetime.now())
+        """Record token usage (入队后立即返回，由后台任务批量写库)"""
+        if self._usage_worker is None or self._usage_worker.done():
+            self._usage_queue = asyncio.Queue()
+            self._usage_worker = asyncio.create_task(self._usage_worker_loop(self._usage_queue))
+        self._usage_queue.put_nowait((token_id, is_video, datetime.now()))
+
+    async def _usage_worker_loop(self, queue: asyncio.Queue):
+        """后台消费使用统计: 攒够 _USAGE_BATCH_MAX 条或 _USAGE_BATCH_WINDOW 秒后合并写入"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + _USAGE_BATCH_WINDOW
+            while len(batch) < _USAGE_BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            # 按 token 聚合: [image_n, video_n, last_used_at]
+            merged: Dict[int, list] = {}
+            for token_id, is_video, used_at in batch:
+                entry = merged.setdefault(token_id, [0, 0, used_at])
+                entry[1 if is_video else 0] += 1
+                entry[2] = used_at
+            try:
+                await self.db.record_usage_batch(
+                    [(token_id, image_n, video_n, used_at) for token_id, (image_n, video_n, used_at) in merged.items()]
+                )
+            except Exception as e:
+                debug_logger.log_error(f"[USAGE] 使用统计写入失败 ({len(batch)} 条): {str(e)}")
 
-        if is_video:
-            await self.db.increment_token_stats(token_id, "video")
-        else:
-            await self.db.increment_token_stats(token_id, "image")
+    async def close(self):
+        """写完队列中剩余的使用统计并停止后台任务"""
+        if self._usage_worker is not None and not self._usage_worker.done():
+            self._usage_queue.put_nowait(None)
+            await self._usage_worker
+        self._usage_worker = None
 
     async def record_error(self, token_id: int):
         """Record token error and auto-disable if threshold reached"""
@@ -381,7 +575,7 @@ class TokenManager:
 
         # Check if should auto-disable token (based on consecutive errors)
         stats = await self.db.get_token_stats(token_id)
-        admin_config = await self.db.get_admin_config()
+        admin_config = await self._get_admin_config_cached()
 
         if stats and stats.consecutive_error_count >= admin_config.error_ban_threshold:
             debug_logger.log_warning(
@@ -411,6 +605,7 @@ class TokenManager:
             ban_reason="429_rate_limit",
             banned_at=datetime.now(timezone.utc)
         )
+        self._invalidate_token_meta(token_id)
 
     async def auto_unban_429_tokens(self):
         """自动解禁因429被禁用的token
@@ -420,56 +615,14 @@ class TokenManager:
         - 仅解禁未过期的token
         - 仅解禁因429被禁用的token
         """
-        all_tokens = await self.db.get_all_tokens()
         now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(hours=12)
 
-        for token in all_tokens:
-            # 跳过非429禁用的token
-            if token.ban_reason != "429_rate_limit":
-                continue
-
-            # 跳过未禁用的token
-            if token.is_active:
-                continue
-
-            # 跳过没有禁用时间的token
-            if not token.banned_at:
-                continue
-
-            # 检查token是否已过期
-            if token.at_expires:
-                # 确保时区一致
-                if token.at_expires.tzinfo is None:
-                    at_expires_aware = token.at_expires.replace(tzinfo=timezone.utc)
-                else:
-                    at_expires_aware = token.at_expires
-
-                # 如果已过期，跳过
-                if at_expires_aware <= now:
-                    debug_logger.log_info(f"[AUTO_UNBAN] Token {token.id} 已过期，跳过解禁")
-                    continue
-
-            # 确保banned_at时区一致
-            if token.banned_at.tzinfo is None:
-                banned_at_aware = token.banned_at.replace(tzinfo=timezone.utc)
-            else:
-                banned_at_aware = token.banned_at
-
-            # 检查是否已过12小时
-            time_since_ban = now - banned_at_aware
-            if time_since_ban.total_seconds() >= 12 * 3600:  # 12小时
-                debug_logger.log_info(
-                    f"[AUTO_UNBAN] 解禁Token {token.id} (禁用时间: {banned_at_aware}, "
-                    f"已过 {time_since_ban.total_seconds() / 3600:.1f} 小时)"
-                )
-                await self.db.update_token(
-                    token.id,
-                    is_active=True,
-                    ban_reason=None,
-                    banned_at=None
-                )
-                # 重置错误计数
-                await self.db.reset_error_count(token.id)
+        # 筛选与解禁在数据库同一事务中完成
+        unbanned_ids = await self.db.auto_unban_429_tokens(now, cutoff)
+        for token_id in unbanned_ids:
+            self._invalidate_token_meta(token_id)
+            debug_logger.log_info(f"[AUTO_UNBAN] 解禁Token {token_id} (禁用已超过12小时)")
 
     # ========== 余额刷新 ==========
 
@@ -483,15 +636,13 @@ class TokenManager:
         if not token:
             return 0
 
-        # 确保AT有效
-        if not await self.is_at_valid(token_id):
+        # 确保AT有效 (复用已读取的token，刷新后直接拿到新AT)
+        at = await self._ensure_valid_at(token)
+        if not at:
             return 0
 
-        # 重新获取token (AT可能已刷新)
-        token = await self.db.get_token(token_id)
-
         try:
-            result = await self.flow_client.get_credits(token.at)
+            result = await self.flow_client.get_credits(at)
             credits = result.get("credits", 0)
 
             # 更新数据库